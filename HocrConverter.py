@@ -28,10 +28,23 @@ from reportlab.pdfgen.canvas import Canvas
 from reportlab.lib.units import inch
 from reportlab.pdfbase import pdfmetrics
 from reportlab.pdfbase.ttfonts import TTFont
-from xml.etree import ElementTree as etree
+try:
+  from lxml import etree
+except ImportError:
+  try:
+    from xml.etree import cElementTree as etree
+  except ImportError:
+    from xml.etree import ElementTree as etree
 import PIL.Image
+try:
+  import numpy
+except ImportError:
+  numpy = None
+import array
+import io
 import re
 import sys
+import functools
 import logging
 import unicodedata
 try:
@@ -47,6 +60,23 @@ except ImportError:
        ' is installed: \n pip install schema\n'
        'https://github.com/halst/schema')
 
+# patterns for the file property of the hOCR title attribute and the namespace of the root tag
+_FILE_RE = re.compile(r".*(file|image)\s((?:\"|')(?:[^'\"]+)(?:['\"])|(?:[^\s'\";]+)).*")
+_NS_RE = re.compile(r'({.*})html')
+
+# classes of the text elements put on the pdf page with their
+# ( text color, bounding box color )
+_CLASS_COLORS = {
+  'ocr_line':  ( (0,0,0), (0,255,0) ),
+  'ocrx_word': ( (0,0,0), (0,255,255) ),
+  'ocr_carea': ( (255,0,0), (255,255,0) ),
+  'ocr_par':   ( (255,0,0), (255,0,0) ),
+}
+
+# the index of a class in _CLASS_NAMES is stored for each text element
+_CLASS_NAMES = tuple( _CLASS_COLORS )
+_CLASS_IDS = dict( (name, class_id) for class_id, name in enumerate(_CLASS_NAMES) )
+
 class HocrConverter():
   """
   A class for converting documents to/from the hOCR format.
@@ -70,9 +100,7 @@ class HocrConverter():
   def __init__(self, hocrFileName = None):
     self.hocr = None
     self.xmlns = ''
-    self.boxPattern = re.compile('bbox((\s+\d+){4})')
-    # self.filenamePattern = re.compile('file\s+(.*)')  
-    self.filenamePattern = re.compile(".*(file|image)\s((?:\"|')(?:[^'\"]+)(?:['\"])|(?:[^\s'\"]+)).*")
+    self._xp_pages = self._xp_text = None
     if hocrFileName is not None:
       self.parse_hocr(hocrFileName)
       
@@ -83,58 +111,45 @@ class HocrConverter():
     if self.hocr is None:
       return ''
     body =  self.hocr.find(".//%sbody"%(self.xmlns))
-    if body:
-      return self._get_element_text(body).encode('utf-8') # XML gives unicode
+    if body is not None:
+      return "".join(body.itertext()) # XML gives unicode
     else:
       return ''
   
-  def _get_element_text(self, element):
-    """
-    Return the textual content of the element and its children
-    """
-    text = ''
-    if element.text is not None:
-      text = text + element.text
-    for child in element.getchildren():
-      text = text + self._get_element_text(child)
-    if element.tail is not None:
-      text = text + element.tail
-    return text
-  
   def parse_element_title(self, element):
-    if 'title' in element.attrib:
-      dict_return = {}
-      
-      vprint( VVERBOSE, element.attrib['title'] )
-      matches = self.boxPattern.search(element.attrib['title'])
-      if matches:
-        coords = matches.group(1).split()
-        out = (int(coords[0]),int(coords[1]),int(coords[2]),int(coords[3]))
-        dict_return[ "bbox" ] = out
-   
-      matches = self.filenamePattern.search(element.attrib['title'])
-      if matches:        
-        dict_return[ "file" ] = matches.groups()[1].strip("\"'")
-    
-    return dict_return
-    
-  def element_coordinates(self, element):
     """
-    Returns a tuple containing the coordinates of the bounding box around
-    an element
+    Parse the bbox and file/image properties of the title attribute,
+    e.g. 'image "page.png"; bbox 0 0 1648 2343; ppageno 0'
+
+    Returns a tuple (bbox, filename), missing properties are None.
     """
-    text_coords = (0,0,0,0)
-    parse_result = self.parse_element_title( element )
-    if "bbox" in parse_result:
-          text_coords = parse_result["bbox"]
+    bbox = filename = None
+    title = element.get('title')
+    if title is None:
+      return (bbox, filename)
+
+    vprint( VVERBOSE, title )
+    for field in title.split(';'):
+      tokens = field.split()
+      # a bbox needs four integers, further values are ignored
+      if len(tokens) >= 5 and tokens[0] == 'bbox':
+        try:
+          bbox = tuple(map(int, tokens[1:5]))
+        except ValueError:
+          pass
+
+    # quoted file names may contain ';', so they are read from the whole title
+    if 'file' in title or 'image' in title:
+      matches = _FILE_RE.search(title)
+      if matches:
+        filename = matches.group(2).strip("\"'")
 
-    return text_coords
+    return (bbox, filename)
 
   def parse_hocr(self, hocrFileName):
     """
     Reads an XML/XHTML file into an ElementTree object
     """
-    self.hocr = etree.ElementTree()
     if hocrFileName == "-":
       try:
         input = sys.stdin.buffer
@@ -145,73 +160,126 @@ class HocrConverter():
       vprint( VERBOSE, stdinstring )
       self.hocr = etree.ElementTree(etree.fromstring(stdinstring))
     else:
-      self.hocr.parse(hocrFileName)
+      self.hocr = etree.parse(hocrFileName)
     
     # if the hOCR file has a namespace, ElementTree requires its use to find elements
-    matches = re.match('({.*})html', self.hocr.getroot().tag)
-    if matches:
-      self.xmlns = matches.group(1)
+    root = self.hocr.getroot()
+    if hasattr(root, 'nsmap'):
+      # lxml knows the namespace of the root element
+      namespace = etree.QName(root).namespace
+      self.xmlns = "{%s}"%(namespace) if namespace else ''
     else:
-      self.xmlns = ''
+      matches = _NS_RE.match(root.tag)
+      if matches:
+        self.xmlns = matches.group(1)
+      else:
+        self.xmlns = ''
+
+    self._xp_pages, self._xp_text = self._compile_queries( self.xmlns )
+
+  def _compile_queries(self, xmlns):
+    """
+    Returns the page and text queries for hOCR elements in the namespace xmlns
+
+    Text is taken from span and p tags with one of the classes in _CLASS_COLORS.
+    """
+    if hasattr(etree, 'XPath'):
+      if xmlns:
+        prefix = 'h:'
+        namespaces = { 'h': xmlns[1:-1] }
+      else:
+        prefix = ''
+        namespaces = None
+      classes = " or ".join( "@class='%s'"%(name) for name in _CLASS_NAMES )
+      xp_pages = etree.XPath("//%sdiv[@class='ocr_page']"%(prefix), namespaces=namespaces)
+      xp_text = etree.XPath(".//*[(self::%sspan or self::%sp) and (%s)]"%(prefix,prefix,classes), namespaces=namespaces)
+    else:
+      # ElementTree has no XPath class, use an ElementPath string and
+      # filter the text elements in Python instead
+      pages_path = ".//%sdiv[@class='ocr_page']"%(xmlns)
+      text_tags = frozenset(( "%sspan"%(xmlns), "%sp"%(xmlns) ))
+      xp_pages = lambda tree: tree.findall(pages_path)
+      xp_text = lambda element: [ child for child in element.iter() if child.tag in text_tags and child.get('class') in _CLASS_COLORS ]
+
+    return (xp_pages, xp_text)
+
+  def _tree_pages(self):
+    """
+    Yields the ocr_page divs of the hOCR read by parse_hocr with their
+    namespace and text query
+    """
+    if self.hocr is None:
+      return
+
+    for page in self._xp_pages(self.hocr):
+      yield (page, self.xmlns, self._xp_text)
+
+  def _iterparse_pages(self, hocrFileName):
+    """
+    Yields the ocr_page divs of an XML/XHTML file one at a time with
+    their namespace and text query
+
+    A page is cleared and removed from the tree when the next one is
+    requested, so only the current page is kept in memory. The hOCR
+    read by parse_hocr is left untouched.
+    """
+    if hocrFileName == "-":
+      try:
+        source = sys.stdin.buffer
+      except AttributeError:
+        source = sys.stdin
+    else:
+      source = open(hocrFileName, 'rb')
+
+    try:
+      if hasattr(etree, 'XPath'):
+        # lxml filters the divs in any or no namespace itself
+        events = etree.iterparse(source, events=('end',), tag='{*}div')
+      else:
+        events = etree.iterparse(source, events=('end',))
+
+      xmlns = xp_text = None
+      for _, element in events:
+        if element.get('class') != 'ocr_page' or not element.tag.endswith('div'):
+          continue
+
+        # the namespace of the page is the one of the document
+        if xp_text is None:
+          xmlns = element.tag[:-len('div')]
+          _, xp_text = self._compile_queries( xmlns )
+
+        yield (element, xmlns, xp_text)
+
+        element.clear()
+        if hasattr(element, 'getprevious'):
+          while element.getprevious() is not None:
+            del element.getparent()[0]
+    finally:
+      if hocrFileName != "-":
+        source.close()
 
   def _setup_image(self, imageFileName):
     
     vprint( INFO, "Image File:", imageFileName )
-      
-    im = PIL.Image.open(imageFileName)
-    imwidthpx, imheightpx = im.size
+
+    # only the header is read here, the pixel data is left to reportlab
+    with PIL.Image.open(imageFileName) as im:
+      size = im.size
+      dpi = im.info.get('dpi')
     
-    vprint( VERBOSE, "Image Dimensions:", im.size )
+    vprint( VERBOSE, "Image Dimensions:", size )
     
-    if 'dpi' in im.info:
-      width = float(im.size[0])/im.info['dpi'][0]
-      height = float(im.size[1])/im.info['dpi'][1]
+    if dpi:
+      width = float(size[0])/dpi[0]
+      height = float(size[1])/dpi[1]
     else:
       # we have to make a reasonable guess
       # set to None for now and try again using info from hOCR file
       width = height = None
     
-    return (im, width, height)
+    return (imageFileName, size, dpi, width, height)
 
-  def get_ocr_text_extension( self, page ):
-    """
-    Get the maximum extension of the area covered by text
-    """
-    if not self.hocr:
-      vprint( VERBOSE, "No hOCR." )
-      return None
-
-    x_min = x_max = y_min = y_max = 0
-
-    for line in page.findall(".//%sspan"%(self.xmlns)):
-      if line.attrib['class'] == 'ocr_line':
-        text_coords = self.element_coordinates(line)
-      
-        for coord_x in [ text_coords[0], text_coords[2] ]:
-          if coord_x > x_max:
-            x_max = coord_x
-          if coord_x < x_min:
-            x_min = coord_x
-        for coord_y in [ text_coords[1], text_coords[3] ]:
-          if coord_y > y_max:
-            y_max = coord_y
-          if coord_y < y_min:
-            y_min = coord_y
-
-    return (x_min,y_min,x_max,y_max)
-
-  def getTextElements( self, parent_element ):
-    text_element_types = [ "p", "span" ]
-    
-    text_elements = []
-    for cat in text_element_types:
-      cat_text_elements = parent_element.findall(".//%s%s"%(self.xmlns,cat))
-      vprint( VVERBOSE, cat,":",len(cat_text_elements) )
-      text_elements.extend( cat_text_elements )
-
-    return text_elements
-
-  def to_pdf(self, imageFileNames, outFileName, fontname="Courier", fontsize=12, withVisibleOCRText=False, withVisibleImage=True, withVisibleBoundingBoxes=False, noPictureFromHocr=False, multiplePages=False, hocrImageReference=False, verticalInversion=False ):
+  def to_pdf(self, imageFileNames, outFileName, fontname="Courier", fontsize=12, withVisibleOCRText=False, withVisibleImage=True, withVisibleBoundingBoxes=False, noPictureFromHocr=False, multiplePages=False, hocrImageReference=False, verticalInversion=False, hocrFileName=None ):
     """
     Creates a PDF file with an image superimposed on top of the text.
     
@@ -220,44 +288,52 @@ class HocrConverter():
     
     The image need not be identical to the image used to create the hOCR file.
     It can be scaled, have a lower resolution, different color mode, etc.
+
+    If hocrFileName is given, its pages are streamed one at a time instead
+    of using the hOCR read by parse_hocr, which keeps memory usage down
+    for large multi-page documents.
     """
    
     # create the PDF file 
     pdf = Canvas(outFileName, pageCompression=1)
 
-    if self.hocr is None:
+    if self.hocr is None and hocrFileName is None:
       # warn that no text will be embedded in the output PDF
       vprint( WARN, "Warning: No hOCR file specified. PDF will be image-only." )
 
     if inputFontFileName is not None:
       pdfmetrics.registerFont(TTFont('Custom', inputFontFileName))
       fontname = "Custom"
+
+    # words repeat a lot in OCR text, cache their width in the used font
+    @functools.lru_cache(maxsize=8192)
+    def string_width( textContent ):
+      return pdf.stringWidth( textContent, fontname, fontsize )
+
+    # pages share images (the last command line image is repeated, the hOCR
+    # image may be the command line one), read the header of each file once
+    setup_image = functools.lru_cache(maxsize=None)(self._setup_image)
     
-    # Collect pages from hOCR
-    pages = []
-    if self.hocr is not None:
-      divs = self.hocr.findall(".//%sdiv"%(self.xmlns))
-      for div in divs:
-        if div.attrib['class'] == 'ocr_page':
-          pages.append(div)
-
-    vprint( VVERBOSE, len(pages), "pages;", len(imageFileNames), "image files from command line." ) 
+    # Pages from hOCR
+    if hocrFileName is not None:
+      pages = self._iterparse_pages(hocrFileName)
+    else:
+      pages = self._tree_pages()
+
+    vprint( VVERBOSE, len(imageFileNames), "image files from command line." ) 
     
     page_count = 0
     # loop pages
     while True:
       page_count += 1
       vprint( VERBOSE, "page", page_count )
-      
-      if len(pages) >= page_count:
-        page = pages[page_count-1] 
-      else:
-        page = None
 
       if page_count > 1:
         if not multiplePages:
           vprint (INFO, "Only processing one page." )
           break # there shouldn't be more than one, and if there is, we don't want it
+
+      page, xmlns, xp_text = next(pages, (None, self.xmlns, None))
      
       imageFileName = None
       
@@ -278,11 +354,13 @@ class HocrConverter():
 
       vprint ( VERBOSE, "Image file name:", imageFileName )
       
-      vprint ( VERBOSE, "page:", page.tag, page.attrib )
+      if page is not None:
+        vprint ( VERBOSE, "page:", page.tag, page.attrib )
       # Dimensions of ocr-page
+      coords = imageFileName_ocr_page = None
       if page is not None:
-        coords = self.element_coordinates( page )
-      else:
+        coords, imageFileName_ocr_page = self.parse_element_title( page )
+      if coords is None:
         coords = (0,0,0,0)
 
       ocrwidth = coords[2]-coords[0]
@@ -290,20 +368,22 @@ class HocrConverter():
       
       # Load command line image
       if imageFileName:
-        im, width, height = self._setup_image(imageFileName)
+        image, size, dpi, width, height = setup_image(imageFileName)
         vprint( VVERBOSE, "width, heigth:", width, height )
       else:
-        im = width = height = None
+        image = size = width = height = None
         
       # Image from hOCR
       # get dimensions, which may not match the image
-      im_ocr = None
+      size_ocr = None
+      # the text elements of the page, their class ids and their bboxes,
+      # four ints per element, are kept in parallel sequences
+      text_elements = []
+      text_class_ids = array.array('b')
+      text_bboxes = array.array('i')
       if page is not None:
-        parse_result = self.parse_element_title( page )
         vprint( VVERBOSE, "ocr_page file ?" )
-        vprint( VVERBOSE, "Parse Results:",parse_result )
-        if "file" in parse_result:
-          imageFileName_ocr_page = parse_result["file"] 
+        if imageFileName_ocr_page is not None:
           vprint( VERBOSE, "ocr_page file", imageFileName_ocr_page, nolinebreak=True )
         
           if noPictureFromHocr:
@@ -314,27 +394,54 @@ class HocrConverter():
           vprint( VERBOSE, "" )
 
           if ( ( not noPictureFromHocr ) and ( not imageFileName) ) or hocrImageReference:
-            im_ocr, width_ocr, height_ocr = self._setup_image(imageFileName_ocr_page)
-            vprint( VERBOSE, "hOCR width, heigth:", width, height )
+            image_ocr, size_ocr, dpi_ocr, width_ocr, height_ocr = setup_image(imageFileName_ocr_page)
+            vprint( VERBOSE, "hOCR width, heigth:", width_ocr, height_ocr )
           if ( not noPictureFromHocr ) and ( not imageFileName):
-            im = im_ocr
+            image = image_ocr
+            size = size_ocr
             width = width_ocr
             height = height_ocr
 
-        # Get size of text area in hOCR-file
-        ocr_text_x_min, ocr_text_y_min, ocr_text_x_max, ocr_text_y_max = self.get_ocr_text_extension( page )
+        # Walk the page once: collect the text elements to put on the pdf
+        # and the extension of the area covered by ocr_line text
+        for element in xp_text( page ):
+          text_class = element.get('class')
+
+          # the title is parsed once, its bbox is reused for rendering
+          text_coords, _ = self.parse_element_title( element )
+          if text_coords is None:
+            continue
+          text_elements.append( element )
+          text_class_ids.append( _CLASS_IDS[text_class] )
+          text_bboxes.extend( text_coords )
+        vprint( VVERBOSE, "text elements:", len(text_elements) )
+
+        # only the far corner of the text area is used for the page size
+        ocr_text_x_max = ocr_text_y_max = 0
+        line_id = _CLASS_IDS['ocr_line']
+        if numpy is not None:
+          bboxes = numpy.frombuffer( text_bboxes, dtype=numpy.intc ).reshape(-1, 4)
+          extension = bboxes[ numpy.frombuffer( text_class_ids, dtype=numpy.int8 ) == line_id ]
+          if len(extension):
+            ocr_text_x_max, ocr_text_y_max = extension[:,2:].max(axis=0).tolist()
+        else:
+          line_rows = [ row for row, class_id in enumerate(text_class_ids) if class_id == line_id ]
+          if line_rows:
+            ocr_text_x_max = max( text_bboxes[4*row+2] for row in line_rows )
+            ocr_text_y_max = max( text_bboxes[4*row+3] for row in line_rows )
+
         ocr_text_width = ocr_text_x_max
         ocr_text_height = ocr_text_y_max
 
         if not ocrwidth:
-          if im_ocr:
-            ocrwidth = im_ocr.size[0]
+          if size_ocr:
+            ocrwidth = size_ocr[0]
           else:
             ocrwidth = ocr_text_width 
 
         if not ocrheight:
-          if im_ocr:
-            ocrheight = im_ocr.size[1]
+          if size_ocr:
+            ocrheight = size_ocr[1]
           else:
             ocrheight = ocr_text_height
      
@@ -357,126 +464,127 @@ class HocrConverter():
           ocr_dpi = (ocrwidth/width, ocrheight/height)
        
           vprint( VERBOSE, "ocr_dpi :", ocr_dpi )
+
+          # factors from hOCR pixels to pdf points, constant for the page
+          scale_x = inch / ocr_dpi[0]
+          scale_y = inch / ocr_dpi[1]
         
         if width is None:
           # no dpi info with the image, and no help from the hOCR file either
           # this will probably end up looking awful, so issue a warning
           vprint( WARN, "Warning: DPI unavailable for image %s. Assuming 96 DPI."%(imageFileName) )
-          width = float(im.size[0])/96
-          height = float(im.size[1])/96
+          width = float(size[0])/96
+          height = float(size[1])/96
           
         # PDF page size
-        pdf.setPageSize((width*inch, height*inch)) # page size in points (1/72 in.)
+        page_width = width*inch
+        page_height = height*inch
+        pdf.setPageSize((page_width, page_height)) # page size in points (1/72 in.)
         
         # put the image on the page, scaled to fill the page
         if withVisibleImage:
-          if im:
-            pdf.drawInlineImage(im, 0, 0, width=width*inch, height=height*inch)
+          if image is not None:
+            # reportlab embeds JPEG files as they are
+            pdf.drawImage(image, 0, 0, width=page_width, height=page_height)
           else:
-            vprint( INFO, "No inline image file supplied." )
+            vprint( INFO, "No image file supplied." )
        
-        # put ocr-content on the page 
-        if self.hocr is not None:
-          text_elements = self.getTextElements( page )
-          
-          for line in text_elements:
-            import pdb
+        # put ocr-content on the page, all lines go into one text object
+        text = pdf.beginText()
+        text.setFont(fontname, fontsize)
+        if not withVisibleOCRText:
+          text.setTextRenderMode(3) # invisible
+        bounding_boxes = []
+        vverbose = logging.root.isEnabledFor( VVERBOSE )
+
+        for row, line in enumerate(text_elements):
+          text_class = _CLASS_NAMES[text_class_ids[row]]
+          base = 4*row
+          if vverbose:
             vprint( VVERBOSE, line.tag, line.attrib )
-            if 'class' in line.attrib:
-              text_class = line.attrib['class']
-            else:
-              text_class = None
-            if text_class in [ 'ocr_line', 'ocrx_word', 'ocr_carea', 'ocr_par' ]:
-              
-              if text_class == 'ocr_line':
-                textColor = (0,0,0)
-                bboxColor = (0,255,0)
-              elif text_class == 'ocrx_word' :
-                textColor = (0,0,0)
-                bboxColor = (0,255,255)
-              elif text_class == 'ocr_carea' :
-                textColor = (255,0,0)
-                bboxColor = (255,255,0)
-              elif text_class == 'ocr_par' :
-                textColor = (255,0,0)
-                bboxColor = (255,0,0)
-              
-              coords = self.element_coordinates( line )
-              parse_result = self.parse_element_title( line )
+          textColor, bboxColor = _CLASS_COLORS[text_class]
+
+          # The content of the text to write
+          if withFullLineText:
+            textContent = unicodedata.normalize("NFC"," ".join([elem for elem in map((lambda text: text.strip()),line.itertext()) if len(elem) > 0]))
+          else:
+            textContent = line.text
+            if ( textContent == None):
+            # Text in tag can be embeded in other tags. In that case
+            # we need to search recursively in all tags
+            # We search recursively only in tags <span> which
+            # contain only non tag span like <strong> or <em>
+              span_child = 0
+              for child_tag in line.iter("%sspan"%(xmlns)):
+                span_child = span_child + 1
+            # The line.tag contain no other <span> tag.
+            # It can contains some text. We search recursively
+            # in all tags contained in this <span> tag
+              if span_child == 1:
+                for string_text in line.itertext():
+                  if string_text != None:
+                     textContent = string_text
+                     break
+            if ( textContent == None ):
+              textContent = u""
+            textContent = textContent.rstrip()
               
-              text = pdf.beginText()
-              text.setFont(fontname, fontsize)
+          # containers like ocr_par hold no text of their own, only their box may be drawn
+          if not textContent and not withVisibleBoundingBoxes:
+            continue
               
-              text_corner1x = (float(coords[0])/ocr_dpi[0])*inch
-              text_corner1y = (float(coords[1])/ocr_dpi[1])*inch
+          text_corner1x = text_bboxes[base]*scale_x
+          text_corner1y = text_bboxes[base+1]*scale_y
 
-              text_corner2x = (float(coords[2])/ocr_dpi[0])*inch
-              text_corner2y = (float(coords[3])/ocr_dpi[1])*inch
+          text_corner2x = text_bboxes[base+2]*scale_x
+          text_corner2y = text_bboxes[base+3]*scale_y
               
-              text_width = text_corner2x - text_corner1x
-              text_height = text_corner2y - text_corner1y
+          text_width = text_corner2x - text_corner1x
+          text_height = text_corner2y - text_corner1y
               
-              if verticalInversion:
-                text_corner2y_inv = (height*inch) - text_corner1y
-                text_corner1y_inv = (height*inch) - text_corner2y
+          if verticalInversion:
+            text_corner2y_inv = page_height - text_corner1y
+            text_corner1y_inv = page_height - text_corner2y
                 
-                text_corner1y = text_corner1y_inv
-                text_corner2y = text_corner2y_inv
-
-              # set cursor to bottom left corner of line bbox (adjust for dpi)
-              text.setTextOrigin( text_corner1x, text_corner1y )
-           
-              # The content of the text to write
-              if withFullLineText:
-                textContent = unicodedata.normalize("NFC",unicode(" ".join([elem for elem in map((lambda text: text.strip()),line.itertext()) if len(elem) > 0])))
-              else:
-                textContent = line.text
-                if ( textContent == None):
-                # Text in tag can be embeded in other tags. In that case
-                # we need to search recursively in all tags
-                # We search recursively only in tags <span> which
-                # contain only non tag span like <strong> or <em>
-                  span_child = 0
-                  for child_tag in line.iter("%sspan"%(self.xmlns)):
-                    span_child = span_child + 1
-                # The line.tag contain no other <span> tag.
-                # It can contains some text. We search recursively
-                # in all tags contained in this <span> tag
-                  if span_child == 1:
-                    for string_text in line.itertext():
-                      if string_text != None:
-                         textContent = string_text
-                         break
-                if ( textContent == None ):
-                  textContent = u""
-                textContent = textContent.rstrip()
-              
-              # scale the width of the text to fill the width of the line's bbox
-              if len(textContent) != 0:
-                text.setHorizScale( ((( float(coords[2])/ocr_dpi[0]*inch ) - ( float(coords[0])/ocr_dpi[0]*inch )) / pdf.stringWidth( textContent, fontname, fontsize))*100)
+            text_corner1y = text_corner1y_inv
+            text_corner2y = text_corner2y_inv
 
-              if not withVisibleOCRText:
-                text.setTextRenderMode(3) # invisible
-             
-              # Text color
-              text.setFillColorRGB(textColor[0],textColor[1],textColor[2])
+          if textContent:
+            # set cursor to bottom left corner of line bbox (adjust for dpi)
+            text.setTextOrigin( text_corner1x, text_corner1y )
 
-              # write the text to the page
-              text.textLine( textContent )
+            # scale the width of the text to fill the width of the line's bbox
+            text.setHorizScale( ( text_width / string_width( textContent ) )*100 )
 
-              vprint( VVERBOSE, "processing", text_class, coords,"->", text_corner1x, text_corner1y, text_corner2x, text_corner2y, ":", textContent )
-              pdf.drawText(text)
+            # Text color
+            text.setFillColorRGB(textColor[0],textColor[1],textColor[2])
 
-              pdf.setLineWidth(0.1)
-              pdf.setStrokeColorRGB(bboxColor[0],bboxColor[1],bboxColor[2])
-       
-              # Draw a box around the text object
-              if withVisibleBoundingBoxes: 
-                pdf.rect( text_corner1x, text_corner1y, text_width, text_height);
+            # write the text to the page
+            text.textLine( textContent )
+
+          if vverbose:
+            vprint( VVERBOSE, "processing", text_class, text_bboxes[base:base+4].tolist(),"->", text_corner1x, text_corner1y, text_corner2x, text_corner2y, ":", textContent )
+
+          # Remember the box around the text object
+          if withVisibleBoundingBoxes: 
+            bounding_boxes.append( (bboxColor, text_corner1x, text_corner1y, text_width, text_height) )
+
+        if text_elements:
+          pdf.drawText(text)
+
+        # Draw the boxes around the text objects
+        if bounding_boxes:
+          pdf.setLineWidth(0.1)
+          for bboxColor, x, y, box_width, box_height in bounding_boxes:
+            pdf.setStrokeColorRGB(bboxColor[0],bboxColor[1],bboxColor[2])
+            pdf.rect( x, y, box_width, box_height )
      
         # finish up the page. A blank new one is initialized as well.
         pdf.showPage()
     
+    # stop reading the hOCR, pages left over are not needed
+    pages.close()
+
     # save the pdf file
     vprint( INFO, "Writing pdf." )
     pdf.save()
@@ -485,9 +593,8 @@ class HocrConverter():
     """
     Writes the textual content of the hOCR body to a file.
     """
-    f = open(outFileName, "w")
-    f.write(self.__str__())
-    f.close()
+    with io.open(outFileName, "w", encoding="utf-8") as f:
+      f.write(self.__str__())
 
 def setGlobal( varName ):
   def setValue( value ):
@@ -530,6 +637,12 @@ def vprint( verbosity, *data, **keywords ):
 
   global _vprint_text
 
+  # Don't format messages nobody will see, this is called in per-element loops
+  if not logging.root.isEnabledFor( verbosity ):
+    if not nolinebreak:
+      _vprint_text = ""
+    return
+
   out_text = _vprint_text
   for out in data:
     if out_text != "":
@@ -538,8 +651,7 @@ def vprint( verbosity, *data, **keywords ):
 
   # If nolinebreak is enabled, save message for next output
   if nolinebreak:
-    if logging.root.isEnabledFor( verbosity ):
-      _vprint_text = out_text
+    _vprint_text = out_text
   else:
     _vprint_text = ""
     logging.log( verbosity, out_text )
@@ -623,5 +735,5 @@ if __name__ == "__main__":
 
   vprint(VVERBOSE, arguments)
   
-  hocr = HocrConverter( inputHocrFileName )
-  hocr.to_pdf( inputImageFileNames, outputPdfFileName, withVisibleOCRText=withVisibleOCRText, withVisibleImage=withVisibleImage, withVisibleBoundingBoxes=withVisibleBoundingBoxes, noPictureFromHocr=noPictureFromHocr, multiplePages=multiplePages, hocrImageReference=hocrImageReference, verticalInversion=verticalInversion )
+  hocr = HocrConverter()
+  hocr.to_pdf( inputImageFileNames, outputPdfFileName, withVisibleOCRText=withVisibleOCRText, withVisibleImage=withVisibleImage, withVisibleBoundingBoxes=withVisibleBoundingBoxes, noPictureFromHocr=noPictureFromHocr, multiplePages=multiplePages, hocrImageReference=hocrImageReference, verticalInversion=verticalInversion, hocrFileName=inputHocrFileName )